@@ -1,12 +1,16 @@
 from __future__ import annotations
 
+import atexit
 import json
 import logging
 import os
+import queue
 import re
 import datetime
 import random
 import threading
+import time
+from collections import deque
 from typing import TYPE_CHECKING
 
 if TYPE_CHECKING:
@@ -20,6 +24,19 @@ from FunPayAPI.types import Order
 from tg_bot import CBT as _CBT, static_keyboards as skb
 from telebot.types import InlineKeyboardMarkup as K, InlineKeyboardButton as B, Message, CallbackQuery
 
+try:
+    import orjson
+
+    def _dumps(obj) -> bytes:
+        return orjson.dumps(obj)
+
+    _loads = orjson.loads
+except ImportError:
+    def _dumps(obj) -> bytes:
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+    _loads = json.loads
+
 NAME = "Auto Response Order"
 VERSION = "1.0.0"
 DESCRIPTION = "Плагин добавляет новую функцию автоматическая отправка сообщения покупателю после оплаты заказа."
@@ -40,11 +57,74 @@ os.makedirs(_STORAGE_PATH, exist_ok=True)
 _SETTINGS_FILE = os.path.join(_STORAGE_PATH, "settings.json")
 
 _RE = RegularExpressions()
+_VAR_PATTERN = (
+    r"\$(?:username|order_id|order_link|order_title|order_desc_or_params|order_desc|order_params"
+    r"|buyer|seller|game|category_full|category|price|currency|amount|date_text|date|full_time|time)"
+)
+_TEMPLATE_RE = re.compile(r"\{([^{}]+)}|(" + _VAR_PATTERN + ")")
+
+_DATE_KEYS = frozenset({"$date", "$date_text", "$time", "$full_time"})
+_CATEGORY_KEYS = frozenset({"$game", "$category", "$category_full"})
 
-_MONTHS = ["", "января", "февраля", "марта", "апреля", "мая", "июня",
-           "июля", "августа", "сентября", "октября", "ноября", "декабря"]
+_HTML_ESCAPE = str.maketrans({"&": "&amp;", "<": "&lt;", ">": "&gt;"})
+
+_MONTHS = ("", "января", "февраля", "марта", "апреля", "мая", "июня",
+           "июля", "августа", "сентября", "октября", "ноября", "декабря")
+
+_PROCESSED_LIMIT = 500
+_FLUSH_INTERVAL = 5.0
+_NON_RETRYABLE_STATUSES = (403, 404)
 
 _lock = threading.Lock()
+_save_lock = threading.Lock()
+_WORKERS = 16
+_order_queue: queue.Queue = queue.Queue()
+
+
+class _Template:
+    __slots__ = ("text", "parts", "keys", "static")
+
+    def __init__(self, text: str):
+        keys: set[str] = set()
+        self.text = text
+        self.parts: tuple = self._compile(text, keys)
+        self.keys: frozenset[str] = frozenset(keys)
+        self.static: str | None = None
+        if all(kind == "lit" for kind, _ in self.parts):
+            self.static = "".join(value for _, value in self.parts)
+
+    @classmethod
+    def _compile(cls, text: str, keys: set[str]) -> tuple:
+        parts = []
+        pos = 0
+        for match in _TEMPLATE_RE.finditer(text):
+            if match.start() > pos:
+                parts.append(("lit", text[pos:match.start()]))
+            spin, var = match.groups()
+            if spin is not None:
+                parts.append(("spin", tuple(cls._compile(choice, keys) for choice in spin.split("|"))))
+            else:
+                parts.append(("var", var))
+                keys.add(var)
+            pos = match.end()
+        if pos < len(text):
+            parts.append(("lit", text[pos:]))
+        return tuple(parts)
+
+    @classmethod
+    def _render(cls, parts: tuple, replacements: dict[str, str]) -> str:
+        out = []
+        for kind, value in parts:
+            if kind == "lit":
+                out.append(value)
+            elif kind == "var":
+                out.append(replacements[value])
+            else:
+                out.append(cls._render(random.choice(value), replacements))
+        return "".join(out)
+
+    def render(self, replacements: dict[str, str]) -> str:
+        return self._render(self.parts, replacements)
 
 
 class Settings:
@@ -58,26 +138,81 @@ class Settings:
             "Сумма: $price $currency\n"
             "Скоро выдам!"
         )
-        self.processed_orders: list[str] = []
+        self.processed_orders: deque[str] = deque(maxlen=_PROCESSED_LIMIT)
+        self._processed_set: set[str] = set()
+        self._dirty: bool = False
+        self._last_hash: int | None = None
+        self._escaped_cache: tuple[str, str] | None = None
+        self._template: _Template = _Template(self.message_text)
+
+    def is_processed(self, order_id: str) -> bool:
+        return order_id in self._processed_set
+
+    def add_processed(self, order_id: str):
+        if len(self.processed_orders) == self.processed_orders.maxlen:
+            self._processed_set.discard(self.processed_orders.popleft())
+        self.processed_orders.append(order_id)
+        self._processed_set.add(order_id)
+
+    def _to_dict(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "watermark": self.watermark,
+            "message_text": self.message_text,
+            "processed_orders": list(self.processed_orders),
+        }
+
+    def update_template(self):
+        self._template = _Template(self.message_text)
+
+    def escaped_message_text(self) -> str:
+        if self._escaped_cache is None or self._escaped_cache[0] != self.message_text:
+            self._escaped_cache = (self.message_text, _escape_html(self.message_text))
+        return self._escaped_cache[1]
+
+    def mark_dirty(self):
+        self._dirty = True
+
+    def flush(self):
+        if self._dirty:
+            self.save()
 
     def save(self):
-        try:
-            self.processed_orders = self.processed_orders[-500:]
-            with open(_SETTINGS_FILE, "w", encoding="utf-8") as f:
-                json.dump(self.__dict__, f, ensure_ascii=False, indent=4)
-        except Exception as e:
-            logger.error(f"Ошибка сохранения настроек: {e}")
+        with _save_lock:
+            with _lock:
+                data = self._to_dict()
+                self._dirty = False
+            try:
+                payload = _dumps(data)
+                payload_hash = hash(payload)
+                if payload_hash == self._last_hash:
+                    return
+                tmp_file = f"{_SETTINGS_FILE}.tmp"
+                with open(tmp_file, "wb") as f:
+                    f.write(payload)
+                os.replace(tmp_file, _SETTINGS_FILE)
+                self._last_hash = payload_hash
+            except Exception as e:
+                self._dirty = True
+                logger.error(f"Ошибка сохранения настроек: {e}")
 
     def load(self):
-        if not os.path.exists(_SETTINGS_FILE):
+        try:
+            with open(_SETTINGS_FILE, "rb") as f:
+                raw = f.read()
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            logger.error(f"Ошибка загрузки настроек: {e}")
             return
         try:
-            with open(_SETTINGS_FILE, "r", encoding="utf-8") as f:
-                data = json.load(f)
+            data = _loads(raw)
             self.enabled = data.get("enabled", self.enabled)
             self.watermark = data.get("watermark", self.watermark)
             self.message_text = data.get("message_text", self.message_text)
-            self.processed_orders = data.get("processed_orders", [])
+            self.update_template()
+            self.processed_orders = deque(data.get("processed_orders", []), maxlen=_PROCESSED_LIMIT)
+            self._processed_set = set(self.processed_orders)
         except Exception as e:
             logger.error(f"Ошибка загрузки настроек: {e}")
 
@@ -86,58 +221,85 @@ SETTINGS = Settings()
 SETTINGS.load()
 
 
+def _flush_loop():
+    while not _flush_stop.wait(_FLUSH_INTERVAL):
+        SETTINGS.flush()
+
+
+def _order_loop():
+    while True:
+        _order_queue.get()()
+
+
+def _shutdown():
+    _flush_stop.set()
+    SETTINGS.flush()
+
+
+_flush_stop = threading.Event()
+threading.Thread(target=_flush_loop, name="ARO-Flush", daemon=True).start()
+for _i in range(_WORKERS):
+    threading.Thread(target=_order_loop, name=f"ARO-{_i}", daemon=True).start()
+atexit.register(_shutdown)
+
+
 def _safe_attr(obj, attr: str, default: str = "") -> str:
     val = getattr(obj, attr, None)
     if val is None:
         return default
+    if isinstance(val, str):
+        return val
     return str(val)
 
 
-def _build_replacements(username: str, order_id: str, order: Order) -> dict[str, str]:
-    now = datetime.datetime.now()
-
-    subcat = getattr(order, "subcategory", None)
-    game_name = subcat.category.name if subcat and hasattr(subcat, "category") else ""
-    subcat_name = subcat.name if subcat else ""
-    subcat_fullname = getattr(subcat, "fullname", "") if subcat else ""
-
+def _build_replacements(username: str, order_id: str, order: Order, keys: frozenset[str]) -> dict[str, str]:
     lot_params_text = getattr(order, "lot_params_text", None) or ""
-    currency_str = str(order.currency) if hasattr(order, "currency") else ""
+    full_description = _safe_attr(order, "full_description")
+    price = getattr(order, "sum", None)
+    currency = getattr(order, "currency", None)
+    amount = getattr(order, "amount", None)
 
-    return {
-        "$date": now.strftime("%d.%m.%Y"),
-        "$date_text": f"{now.day} {_MONTHS[now.month]}",
-        "$time": now.strftime("%H:%M"),
-        "$full_time": now.strftime("%H:%M:%S"),
+    replacements = {
         "$username": username,
         "$order_id": order_id,
         "$order_link": f"https://funpay.com/orders/{order_id}/",
         "$order_title": _safe_attr(order, "short_description"),
-        "$order_desc": _safe_attr(order, "full_description"),
+        "$order_desc": full_description,
         "$order_params": lot_params_text,
-        "$order_desc_or_params": _safe_attr(order, "full_description") or lot_params_text,
+        "$order_desc_or_params": full_description or lot_params_text,
         "$buyer": _safe_attr(order, "buyer_username"),
         "$seller": _safe_attr(order, "seller_username"),
-        "$game": game_name,
-        "$category": f"{subcat_name} {game_name}".strip(),
-        "$category_full": subcat_fullname,
-        "$price": str(order.sum) if hasattr(order, "sum") and order.sum is not None else "",
-        "$currency": currency_str,
-        "$amount": str(order.amount) if hasattr(order, "amount") else "1",
+        "$price": "" if price is None else str(price),
+        "$currency": "" if currency is None else str(currency),
+        "$amount": "1" if amount is None else str(amount),
     }
 
+    if not keys.isdisjoint(_DATE_KEYS):
+        now = datetime.datetime.now()
+        date, time_, full_time = now.strftime("%d.%m.%Y|%H:%M|%H:%M:%S").split("|")
+        replacements["$date"] = date
+        replacements["$date_text"] = f"{now.day} {_MONTHS[now.month]}"
+        replacements["$time"] = time_
+        replacements["$full_time"] = full_time
 
-def process_text(raw_text: str, username: str, order_id: str, order: Order) -> str:
-    def spin(match):
-        return random.choice(match.group(1).split("|"))
+    if not keys.isdisjoint(_CATEGORY_KEYS):
+        subcat = getattr(order, "subcategory", None)
+        category = getattr(subcat, "category", None)
+        game_name = category.name if category else ""
+        subcat_name = subcat.name if subcat else ""
+        replacements["$game"] = game_name
+        replacements["$category"] = f"{subcat_name} {game_name}".strip()
+        replacements["$category_full"] = getattr(subcat, "fullname", "") if subcat else ""
 
-    text = re.sub(r"\{([^{}]+)}", spin, raw_text)
+    return replacements
 
-    replacements = _build_replacements(username, order_id, order)
-    for key, value in replacements.items():
-        text = text.replace(key, value)
 
-    return text
+def process_text(template: _Template, username: str, order_id: str, order: Order) -> str:
+    if template.static is not None:
+        return template.static
+    if not template.keys:
+        return template.render({})
+    return template.render(_build_replacements(username, order_id, order, template.keys))
 
 
 def message_hook(cardinal: Cardinal, event: NewMessageEvent):
@@ -150,19 +312,23 @@ def message_hook(cardinal: Cardinal, event: NewMessageEvent):
     if event.message.i_am_buyer:
         return
 
-    order_ids = _RE.ORDER_ID.findall(str(event.message))
-    if not order_ids:
-        return
-    order_id = order_ids[0][1:]
+    order_id = getattr(event.message, "order_id", None)
+    if order_id:
+        order_id = str(order_id).lstrip("#")
+    else:
+        order_ids = _RE.ORDER_ID.findall(str(event.message))
+        if not order_ids:
+            return
+        order_id = order_ids[0][1:]
 
     with _lock:
-        if order_id in SETTINGS.processed_orders:
+        if SETTINGS.is_processed(order_id):
             return
-        SETTINGS.processed_orders.append(order_id)
-        SETTINGS.save()
+        SETTINGS.add_processed(order_id)
+        SETTINGS.mark_dirty()
 
-    raw_text = SETTINGS.message_text
-    if not raw_text or not raw_text.strip():
+    template = SETTINGS._template
+    if not template.text.strip():
         return
 
     chat_id = event.message.chat_id
@@ -170,8 +336,6 @@ def message_hook(cardinal: Cardinal, event: NewMessageEvent):
 
     def worker():
         try:
-            import time as _time
-
             order = None
             for attempt in range(3):
                 try:
@@ -179,15 +343,19 @@ def message_hook(cardinal: Cardinal, event: NewMessageEvent):
                     if order:
                         break
                 except Exception as e:
+                    if getattr(e, "status_code", None) in _NON_RETRYABLE_STATUSES:
+                        logger.error(f"Заказ #{order_id} недоступен: {e}")
+                        return
                     logger.warning(f"Попытка {attempt + 1}/3 получения заказа #{order_id}: {e}")
-                    _time.sleep(2)
+                    if attempt < 2:
+                        time.sleep(0.5 * (3 ** attempt) * random.uniform(0.8, 1.2))
 
             if not order:
                 logger.error(f"Не удалось получить данные заказа #{order_id} после 3 попыток.")
                 return
 
             username = chat_name or _safe_attr(order, "buyer_username", "Покупатель")
-            text = process_text(raw_text, username, order_id, order)
+            text = process_text(template, username, order_id, order)
 
             if not text.strip():
                 return
@@ -208,27 +376,42 @@ def message_hook(cardinal: Cardinal, event: NewMessageEvent):
             logger.error(f"Ошибка обработки заказа #{order_id}: {e}")
             logger.debug("TRACEBACK", exc_info=True)
 
-    threading.Thread(target=worker, daemon=True).start()
+    _order_queue.put(worker)
 
 
 def _escape_html(text: str) -> str:
-    return text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+    return text.translate(_HTML_ESCAPE)
+
+
+_main_text_cache: tuple[tuple[bool, bool, str], str] | None = None
+_main_kb_cache: tuple[tuple[bool, bool], K] | None = None
 
 
 def _main_text() -> str:
+    global _main_text_cache
+    key = (SETTINGS.enabled, SETTINGS.watermark, SETTINGS.message_text)
+    if _main_text_cache is not None and _main_text_cache[0] == key:
+        return _main_text_cache[1]
+
     header = (
         f"⚙️ <b>Настройки авто-ответа после оплаты</b>\n\n"
         f"∟ Авто-ответ: {'🟢 Включен' if SETTINGS.enabled else '🔴 Выключен'}\n"
         f"∟ Водяной знак: {'🟢 Да' if SETTINGS.watermark else '🔴 Нет'}\n\n"
     )
     if SETTINGS.message_text and SETTINGS.message_text.strip():
-        header += f"📝 Текст сообщения:\n<code>{_escape_html(SETTINGS.message_text)}</code>"
+        header += f"📝 Текст сообщения:\n<code>{SETTINGS.escaped_message_text()}</code>"
     else:
         header += "❌ Текст сообщения не установлен."
+    _main_text_cache = (key, header)
     return header
 
 
 def _main_kb() -> K:
+    global _main_kb_cache
+    key = (SETTINGS.enabled, SETTINGS.watermark)
+    if _main_kb_cache is not None and _main_kb_cache[0] == key:
+        return _main_kb_cache[1]
+
     kb = K()
     kb.add(B(
         f"{'🟢' if SETTINGS.enabled else '🔴'} Авто-ответ",
@@ -240,6 +423,7 @@ def _main_kb() -> K:
     ))
     kb.add(B("📝 Изменить текст", callback_data=CBT_TEXT_SHOW))
     kb.add(B("◀️ Назад", callback_data=f"{_CBT.EDIT_PLUGIN}:{UUID}:0"))
+    _main_kb_cache = (key, kb)
     return kb
 
 
@@ -309,7 +493,7 @@ def init_commands(cardinal: Cardinal, *args):
         )
 
         if SETTINGS.message_text and SETTINGS.message_text.strip():
-            text = f"📝 <b>Текст сообщения:</b>\n\n<code>{_escape_html(SETTINGS.message_text)}</code>"
+            text = f"📝 <b>Текст сообщения:</b>\n\n<code>{SETTINGS.escaped_message_text()}</code>"
         else:
             text = "❌ Текст сообщения не установлен."
 
@@ -344,6 +528,7 @@ def init_commands(cardinal: Cardinal, *args):
             SETTINGS.message_text = ""
         else:
             SETTINGS.message_text = message.text or ""
+        SETTINGS.update_template()
 
         SETTINGS.save()
 